@@ -1,6 +1,8 @@
 import os
+import time
 import msal
 import logging
+import threading
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -9,32 +11,122 @@ load_dotenv()
 CLIENT_ID = os.getenv("CLIENT_ID")
 TENANT_ID = os.getenv("TENANT_ID")
 REDIRECT_URI = os.getenv("REDIRECT_URI")
+TOKEN_CACHE = os.getenv(
+    "TOKEN_CACHE", os.path.join(os.path.dirname(__file__), "token_cache.bin")
+)
+# Refresh the token this many seconds before it expires
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", "300"))
+SCOPES = [
+    "User.Read",
+    "Files.ReadWrite.All",
+    "Sites.ReadWrite.All",
+    "Sites.Manage.All",
+    "Mail.Send",
+]
+
+
+class TokenProvider:
+    def __init__(self, cache_path=TOKEN_CACHE, margin=TOKEN_REFRESH_MARGIN):
+        self.cache_path = cache_path
+        self.margin = margin
+        # Persistent MSAL cache, so restarts can skip the interactive sign-in
+        self.cache = msal.SerializableTokenCache()
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                self.cache.deserialize(f.read())
+
+        # Create a PublicClientApplication object
+        self.app = msal.PublicClientApplication(
+            CLIENT_ID,
+            authority=f"https://login.microsoftonline.com/{TENANT_ID}",
+            token_cache=self.cache,
+        )
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires_at = 0
+        self.thread = None
+
+    # Acquire a token silently from cache, sign in interactively if allowed
+    def acquire(self, force_refresh=False, interactive=True):
+        result = None
+        accounts = self.app.get_accounts()
+        if accounts:
+            result = self.app.acquire_token_silent(
+                scopes=SCOPES, account=accounts[0], force_refresh=force_refresh
+            )
+
+        # If a token cannot be acquired silently, prompt the user to sign in
+        if not result or "access_token" not in result:
+            if not interactive:
+                raise Exception("Silent token refresh failed.")
+            result = self.app.acquire_token_interactive(scopes=SCOPES)
+            if "access_token" not in result:
+                raise Exception("Authentication failed.")
+            logging.info("Authentication successful.")
+
+        self.token = result["access_token"]
+        self.expires_at = time.time() + int(result.get("expires_in", 3600))
+        self.save()
+        return self.token
+
+    # Get the current token, refresh it first if it is about to expire
+    def get_token(self):
+        with self.lock:
+            if self.token is None or time.time() >= self.expires_at - self.margin:
+                self.acquire()
+            return self.token
+
+    # Clients call the provider to get the token of each request
+    def __call__(self):
+        return self.get_token()
+
+    # Save the MSAL cache to disk when it changed
+    def save(self):
+        if not self.cache.has_state_changed:
+            return
+        try:
+            fd = os.open(self.cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(self.cache.serialize())
+        except Exception as e:
+            logging.warning(f"Save token cache failed. {e}")
+
+    # Refresh the token silently in the background before it expires
+    def start(self):
+        self.get_token()
+        self.thread = threading.Thread(
+            target=self.refresh_loop, name="token-refresh", daemon=True
+        )
+        self.thread.start()
+        return self
+
+    def refresh_loop(self):
+        while True:
+            time.sleep(max(self.expires_at - self.margin - time.time(), 1))
+            try:
+                with self.lock:
+                    if time.time() >= self.expires_at - self.margin:
+                        self.acquire(force_refresh=True, interactive=False)
+                        logging.info("Access token refreshed.")
+            except Exception as e:
+                # Retry in a minute, get_token falls back to interactive sign-in
+                logging.error(f"Refresh access token failed. {e}")
+                time.sleep(60)
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+# Get the process-wide token provider, sign in and start it on first use
+def get_token_provider():
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                _provider = TokenProvider().start()
+    return _provider
 
 
 def get_access_token():
-    # Create a PublicClientApplication object
-    app = msal.PublicClientApplication(
-        CLIENT_ID, authority=f"https://login.microsoftonline.com/{TENANT_ID}"
-    )
-
-    # Try to acquire a token silently from cache
-    scopes = [
-        "User.Read",
-        "Files.ReadWrite.All",
-        "Sites.ReadWrite.All",
-        "Sites.Manage.All",
-        "Mail.Send",
-    ]
-    accounts = app.get_accounts()
-    if accounts:
-        result = app.acquire_token_silent(scopes=scopes, account=accounts[0])
-        if result:
-            return result["access_token"]
-
-    # If a token cannot be acquired silently, prompt the user to sign in
-    result = app.acquire_token_interactive(scopes=scopes)
-    if "access_token" in result:
-        logging.info("Authentication successful.")
-        return result["access_token"]
-    else:
-        raise Exception("Authentication failed.")
+    return get_token_provider().get_token()
@@ -0,0 +1,512 @@
+import os
+import re
+import sys
+import json
+import time
+import base64
+import random
+import logging
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import importlib
+from collections import Counter
+from urllib.parse import urlparse, parse_qs, unquote
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DRIVE_ID = "mock-drive"
+EXCEL_NAME = "RequestForm.xlsx"
+SHEET_NAME = "Form"
+BASE_URL = "https://mock.sharepoint.com/sites/rpabay/base"
+SENT_URL = "https://mock.sharepoint.com/sites/rpabay/sent"
+SOURCE_URL = "https://mock.sharepoint.com/sites/engineering/source"
+START_ROW = 6
+
+ITEM_PATH = r"^/drives/[^/]+/items/([^/]+)"
+SHEET_PATH = ITEM_PATH + r"/workbook/worksheets\('([^']+)'\)"
+RANGE_PATH = SHEET_PATH + r"/range\(address='([A-Z])(\d+):([A-Z])(\d+)'\)$"
+
+
+# Convert a column letter to a zero based index
+def column_index(letter):
+    return ord(letter) - ord("A")
+
+
+class MockGraph:
+    def __init__(self, latency=0.0, throttle=0.0, copy_delay=0.0, page_size=200):
+        self.latency = latency
+        self.throttle = throttle
+        self.copy_delay = copy_delay
+        self.page_size = page_size
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.items = {}
+        self.shares = {}
+        self.sheet = {}
+        self.copies = {}
+        self.sessions = 0
+        self.version = 0
+
+    # Add a file or folder under the parent, return its ID
+    def add_item(self, parent_id, name, folder=False, size=0, alias=None):
+        item_id = f"item-{len(self.items)}"
+        self.items[item_id] = {
+            "id": item_id,
+            "name": name,
+            "folder": folder,
+            "size": size,
+            "children": [],
+            "alias": alias,
+        }
+        if parent_id is not None:
+            self.items[parent_id]["children"].append(item_id)
+        return item_id
+
+    # Add a folder tree of the given depth under the parent
+    def add_tree(self, parent_id, depth, breadth, files):
+        for i in range(files):
+            self.add_item(parent_id, f"file-{i}.stp", size=(i + 1) * 512 * 1024)
+        if depth > 0:
+            for i in range(breadth):
+                folder_id = self.add_item(parent_id, f"folder-{i}", folder=True)
+                self.add_tree(folder_id, depth - 1, breadth, files)
+
+    # Build the request form, the sent folder and the source folders
+    def setup(self, rows, sources, companies, depth, breadth, files):
+        with self.lock:
+            self.items.clear()
+            self.shares.clear()
+            self.sheet.clear()
+            self.copies.clear()
+            self.calls.clear()
+
+            base_id = self.add_item(None, "base", folder=True)
+            self.add_item(base_id, EXCEL_NAME, size=1024 * 1024)
+            self.shares[BASE_URL] = base_id
+
+            sent_id = self.add_item(None, "sent", folder=True)
+            for i in range(companies):
+                self.add_item(sent_id, f"Company {i}", folder=True)
+            self.shares[SENT_URL] = sent_id
+
+            for i in range(sources):
+                source_id = self.add_item(None, f"source-{i}", folder=True)
+                self.add_tree(source_id, depth, breadth, files)
+                self.shares[f"{SOURCE_URL}/{i}"] = source_id
+
+            # The used range of the sheet starts at B2, the rows start at row 6
+            for i in range(rows):
+                row = [""] * 25
+                row[1:20] = [
+                    "OEM",
+                    f"Project {i}",
+                    "System",
+                    f"Part {i}",
+                    f"PN-{i}",
+                    "",
+                    "",
+                    f"{SOURCE_URL}/{i % sources}",
+                    "",
+                    "Responsible",
+                    "responsible@example.com",
+                    "cc@example.com",
+                    "",
+                    "",
+                    f"Company {i % companies}",
+                    "Subject",
+                    "Comment",
+                    "Supplier",
+                    f"supplier{i}@example.com",
+                ]
+                row[20] = "Gönder."
+                self.sheet[START_ROW + i] = row
+            self.version += 1
+
+    # Get the children of the item, a copy lists the children of its source
+    def children(self, item_id):
+        item = self.items[item_id]
+        while item["alias"] is not None:
+            item = self.items[item["alias"]]
+        return item["children"]
+
+    def item_json(self, item_id):
+        item = self.items[item_id]
+        data = {
+            "id": item_id,
+            "name": item["name"],
+            "size": item["size"],
+            "parentReference": {"driveId": DRIVE_ID},
+            "cTag": f"ctag-{self.version}",
+            "eTag": f"etag-{self.version}",
+        }
+        if item["folder"]:
+            data["folder"] = {"childCount": len(self.children(item_id))}
+        return data
+
+    # Count the call by endpoint class
+    def count(self, path):
+        if path.startswith("/monitor/"):
+            name = "monitor"
+        elif "/workbook/" in path:
+            name = "workbook"
+        elif path.endswith("/sendMail"):
+            name = "mail"
+        elif path.endswith("/$batch"):
+            name = "batch"
+        else:
+            name = "drive"
+        with self.lock:
+            self.calls[name] += 1
+            self.calls["total"] += 1
+
+    # Handle a request, return (status, headers, body)
+    def handle(self, method, path, query, body, host):
+        self.count(path)
+        if self.throttle and self.random.random() < self.throttle:
+            with self.lock:
+                self.calls["throttled"] += 1
+            return 429, {"Retry-After": "0"}, {"error": {"code": "TooManyRequests"}}
+
+        if path.startswith("/monitor/"):
+            return self.monitor(path.split("/")[-1])
+        path = path[len("/v1.0") :] if path.startswith("/v1.0") else path
+
+        if path == "/$batch" and method == "POST":
+            responses = []
+            for request in body["requests"]:
+                url = urlparse(request["url"])
+                status, headers, data = self.handle(
+                    request["method"],
+                    "/v1.0" + unquote(url.path),
+                    parse_qs(url.query),
+                    request.get("body"),
+                    host,
+                )
+                responses.append(
+                    {
+                        "id": request["id"],
+                        "status": status,
+                        "headers": headers,
+                        "body": data,
+                    }
+                )
+            return 200, {}, {"responses": responses}
+        if path == "/me/sendMail" and method == "POST":
+            return 202, {}, None
+
+        match = re.match(r"^/shares/u!([^/]+)/driveItem$", path)
+        if match:
+            encoded = match.group(1).replace("_", "/").replace("-", "+")
+            url = base64.b64decode(encoded + "=" * (-len(encoded) % 4)).decode("utf-8")
+            if url not in self.shares:
+                return 404, {}, {"error": {"code": "itemNotFound"}}
+            return 200, {}, self.item_json(self.shares[url])
+
+        match = re.match(RANGE_PATH, path)
+        if match:
+            return self.range(method, match.groups()[2:], body)
+        match = re.match(SHEET_PATH + r"/usedRange\(valuesOnly=true\)$", path)
+        if match:
+            last_row = max(self.sheet, default=START_ROW)
+            return 200, {}, {"address": f"{SHEET_NAME}!B2:Y{last_row}"}
+        match = re.match(ITEM_PATH + r"/workbook/(\w+)Session$", path)
+        if match:
+            with self.lock:
+                self.sessions += 1
+            return 201, {}, {"id": f"session-{self.sessions}"}
+
+        match = re.match(ITEM_PATH + r"(/\w+)?$", path)
+        if not match or match.group(1) not in self.items:
+            return 404, {}, {"error": {"code": "itemNotFound"}}
+        item_id, action = match.groups()
+        if action is None:
+            return 200, {}, self.item_json(item_id)
+        if action == "/children":
+            return self.list_children(item_id, query, host)
+        if action == "/copy":
+            return self.copy(item_id, body, host)
+        if action == "/createLink":
+            link = f"https://mock.sharepoint.com/s/{item_id}"
+            return 200, {}, {"link": {"webUrl": link}}
+        if action == "/invite":
+            return 200, {}, {"value": []}
+        return 404, {}, {"error": {"code": "invalidRequest"}}
+
+    def list_children(self, item_id, query, host):
+        skip = int(query.get("$skiptoken", ["0"])[0])
+        children = self.children(item_id)
+        page = children[skip : skip + self.page_size]
+        data = {"value": [self.item_json(child_id) for child_id in page]}
+        if skip + self.page_size < len(children):
+            data["@odata.nextLink"] = (
+                f"http://{host}/v1.0/drives/{DRIVE_ID}/items/{item_id}/children"
+                f"?$skiptoken={skip + self.page_size}"
+            )
+        return 200, {}, data
+
+    def copy(self, item_id, body, host):
+        with self.lock:
+            parent_id = body["parentReference"]["id"]
+            copy_id = self.add_item(parent_id, body["name"], folder=True, alias=item_id)
+            job = str(len(self.copies))
+            self.copies[job] = (time.monotonic(), copy_id)
+        return 202, {"Location": f"http://{host}/monitor/{job}"}, None
+
+    def monitor(self, job):
+        started, copy_id = self.copies[job]
+        elapsed = time.monotonic() - started
+        if elapsed >= self.copy_delay:
+            return 200, {}, {"status": "completed", "resourceId": copy_id}
+        percentage = round(100 * elapsed / self.copy_delay, 1)
+        return 200, {}, {"status": "inProgress", "percentageComplete": percentage}
+
+    def range(self, method, address, body):
+        col_start, row_start, col_end, row_end = address
+        first, last = column_index(col_start), column_index(col_end) + 1
+        rows = range(int(row_start), int(row_end) + 1)
+        if method == "PATCH":
+            with self.lock:
+                for row_idx, values in zip(rows, body["values"]):
+                    row = self.sheet.setdefault(row_idx, [""] * 25)
+                    row[first:last] = values
+                self.version += 1
+            return 200, {}, {}
+        values = [self.sheet.get(row_idx, [""] * 25)[first:last] for row_idx in rows]
+        return 200, {}, {"values": values}
+
+
+class MockGraphHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PATCH(self):
+        self.dispatch("PATCH")
+
+    def dispatch(self, method):
+        graph = self.server.graph
+        if graph.latency:
+            time.sleep(graph.latency)
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length)) if length else None
+        status, headers, data = graph.handle(
+            method, unquote(url.path), parse_qs(url.query), body, self.headers["Host"]
+        )
+        payload = json.dumps(data).encode("utf-8") if data is not None else b""
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Start the mock Graph server on a free local port
+def start_server(graph):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockGraphHandler)
+    server.daemon_threads = True
+    server.graph = graph
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Run one cycle on a fresh form, then an idle cycle on the same form
+def run_scenario(rpa, graph, args, rows):
+    from sharepoint import share_cache, dir_index_cache
+
+    graph.setup(
+        rows, args.sources, args.companies, args.depth, args.breadth, args.files
+    )
+    share_cache.clear()
+    dir_index_cache.clear()
+    rpa.get_journal().clear()
+
+    tracemalloc.start()
+    rpa.metrics.start_cycle(f"benchmark-{rows}")
+    start_time = time.perf_counter()
+    request_form = rpa.main("benchmark-token")
+    wall_time = time.perf_counter() - start_time
+    summary = rpa.metrics.end_cycle()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    calls = Counter(graph.calls)
+
+    graph.calls.clear()
+    start_time = time.perf_counter()
+    rpa.main("benchmark-token", request_form)
+    idle_time = time.perf_counter() - start_time
+
+    sent = sum(1 for row in graph.sheet.values() if row[23] == "Gönderildi.")
+    return {
+        "rows": rows,
+        "sent": sent,
+        "wall_time": round(wall_time, 3),
+        "calls": calls["total"],
+        "calls_per_row": round(calls["total"] / rows, 2),
+        "calls_by_class": dict(calls),
+        "peak_memory_mb": round(peak_memory / (1024 * 1024), 2),
+        "steps": summary["steps"],
+        "idle_time": round(idle_time, 3),
+        "idle_calls": graph.calls["total"],
+    }
+
+
+# Post to the trigger listener, return the status and the response body
+def post(url, data=None):
+    body = json.dumps(data).encode("utf-8") if data is not None else b""
+    request = Request(url, data=body, method="POST")
+    request.add_header("Content-Type", "application/json")
+    try:
+        with urlopen(request, timeout=5) as response:
+            return response.status, response.read().decode("utf-8")
+    except HTTPError as e:
+        return e.code, e.read().decode("utf-8")
+
+
+# Post a burst of change notifications to a local trigger listener
+# Check the validation handshake, the clientState check and the debounce
+def run_trigger_check(burst, debounce):
+    from trigger import Trigger
+
+    secret = "benchmark-state"
+    trigger = Trigger(host="127.0.0.1", port=0, secret=secret, debounce=debounce)
+    trigger.start()
+    wakeups = []
+    stop = threading.Event()
+
+    def wait_for_cycles():
+        while not stop.is_set():
+            if trigger.wait(0.1):
+                wakeups.append(time.perf_counter())
+
+    waiter = threading.Thread(target=wait_for_cycles, daemon=True)
+    waiter.start()
+
+    handshake = post(f"{trigger.address}/?validationToken=benchmark-token")
+    rejected = [
+        post(trigger.address, body)[0]
+        for body in ({"value": [{"clientState": "wrong"}]}, [], "x", {"value": ["x"]})
+    ]
+    notification = {"value": [{"clientState": secret, "changeType": "updated"}]}
+    start_time = time.perf_counter()
+    accepted = [post(trigger.address, notification)[0] for _ in range(burst)]
+    # Let the debounce window of the burst run out
+    time.sleep(debounce * 2 + 0.5)
+    stop.set()
+    waiter.join()
+    trigger.stop()
+
+    result = {
+        "burst": burst,
+        "handshake": handshake == (200, "benchmark-token"),
+        "rejected": rejected == [403] * len(rejected),
+        "accepted": accepted.count(202),
+        "wakeups": len(wakeups),
+        "wakeup_delay": round(wakeups[0] - start_time, 3) if wakeups else None,
+    }
+    result["ok"] = (
+        result["handshake"]
+        and result["rejected"]
+        and result["accepted"] == burst
+        and result["wakeups"] == 1
+    )
+    return result
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark a cycle against a local Microsoft Graph stand-in."
+    )
+    parser.add_argument("--rows", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--sources", type=int, default=5, help="distinct data links")
+    parser.add_argument("--companies", type=int, default=20)
+    parser.add_argument("--depth", type=int, default=3, help="folder tree depth")
+    parser.add_argument("--breadth", type=int, default=3, help="subfolders per folder")
+    parser.add_argument("--files", type=int, default=5, help="files per folder")
+    parser.add_argument("--copy-delay", type=float, default=0.5, help="seconds")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--throttle", type=float, default=0.0, help="429 ratio")
+    parser.add_argument("--page-size", type=int, default=200)
+    parser.add_argument("--json", action="store_true", help="print JSON lines")
+    parser.add_argument(
+        "--trigger",
+        type=int,
+        metavar="BURST",
+        help="check the trigger listener with a burst of notifications instead",
+    )
+    parser.add_argument("--debounce", type=float, default=1.0, help="seconds")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    graph = MockGraph(args.latency, args.throttle, args.copy_delay, args.page_size)
+    server = start_server(graph)
+    host, port = server.server_address[:2]
+
+    # Point the application to the mock server before it is imported
+    workdir = tempfile.mkdtemp(prefix="rpabay-benchmark-")
+    os.environ.update(
+        {
+            "GRAPH_BASE_URL": f"http://{host}:{port}/v1.0",
+            "FREQUENCY": "60",
+            "RPABAY_DATA_MANAGEMENT_REQUEST_FORM": EXCEL_NAME,
+            "RPABAY_DATA_MANAGEMENT_REQUEST_FORM_SHEET": SHEET_NAME,
+            "RPABAY_DATA_MANAGEMENT": BASE_URL,
+            "RPABAY_DATA_GIDEN": SENT_URL,
+            "JOURNAL_PATH": os.path.join(workdir, "journal.db"),
+            "LOG_PATH": os.path.join(workdir, "app.log"),
+        }
+    )
+    os.environ.pop("SHARE_CACHE_PATH", None)
+    os.environ.setdefault("GRAPH_BACKOFF", "0.1")
+    os.environ.setdefault("COPY_POLL_MIN", "0.1")
+    os.environ.setdefault("COPY_POLL_MAX", "2")
+    os.chdir(workdir)
+    rpa = importlib.import_module("main")
+    logging.getLogger().setLevel(logging.ERROR)
+
+    if args.trigger is not None:
+        result = run_trigger_check(args.trigger, args.debounce)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(
+                f"trigger | {result['burst']} notifications -> "
+                f"{result['wakeups']} wake-ups | handshake {result['handshake']} | "
+                f"clientState rejected {result['rejected']} | "
+                f"{'OK' if result['ok'] else 'FAILED'}"
+            )
+        server.shutdown()
+        return 0 if result["ok"] else 1
+
+    for rows in args.rows:
+        result = run_scenario(rpa, graph, args, rows)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(
+                f"{result['rows']:>6} rows | sent {result['sent']:>6} | "
+                f"{result['wall_time']:>8.2f}s | {result['calls']:>6} calls "
+                f"({result['calls_per_row']:.2f}/row) | "
+                f"peak {result['peak_memory_mb']:.1f}MB | "
+                f"idle {result['idle_time']:.2f}s / {result['idle_calls']} calls"
+            )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    def __init__(self, maxsize=256, ttl=3600, path=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.lock = threading.Lock()
+        # key -> (value, expiry timestamp), least recently used first
+        self.items = OrderedDict()
+        if self.path:
+            self.load()
+
+    # Get the value of the key, None if it is missing or expired
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires <= time.time():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return value
+
+    # Set the value of the key, evict the least recently used keys when full
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = (value, time.time() + self.ttl)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+        self.save()
+
+    # Remove the key from the cache
+    def invalidate(self, key):
+        with self.lock:
+            removed = self.items.pop(key, None) is not None
+        if removed:
+            self.save()
+
+    # Remove every key from the cache
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+        self.save()
+
+    # Load the unexpired items from the cache file
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.warning(f"Load cache '{self.path}' failed. {e}")
+            return
+
+        now = time.time()
+        with self.lock:
+            for key, value, expires in data[-self.maxsize :]:
+                if expires > now:
+                    self.items[key] = (value, expires)
+
+    # Save the items to the cache file
+    def save(self):
+        if not self.path:
+            return
+        try:
+            with self.lock:
+                data = [[key, *item] for key, item in self.items.items()]
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.path)
+        except Exception as e:
+            logging.warning(f"Save cache '{self.path}' failed. {e}")
@@ -0,0 +1,157 @@
+import os
+import time
+import logging
+import threading
+import contextvars
+import requests
+from concurrent.futures import Future
+from dotenv import load_dotenv
+
+from graph import get_client, GRAPH_MAX_RETRIES, RETRY_STATUSES
+
+# Load environment variables from .env file
+load_dotenv()
+COPY_POLL_MIN = float(os.getenv("COPY_POLL_MIN", "1"))
+COPY_POLL_MAX = float(os.getenv("COPY_POLL_MAX", "30"))
+COPY_POLL_BACKOFF = 1.5
+
+
+class CopyJob:
+    def __init__(self, location, verify, interval):
+        self.location = location
+        self.verify = verify
+        self.future = Future()
+        # Context of the caller, the polls count towards its cycle
+        self.context = contextvars.copy_context()
+        self.interval = interval
+        self.next_poll = time.monotonic() + interval
+        # Last (time, percentageComplete) sample to estimate the copy rate
+        self.sample = None
+        # Polls in a row that got no answer
+        self.failures = 0
+
+
+class CopyTracker:
+    def __init__(
+        self, client=None, min_interval=COPY_POLL_MIN, max_interval=COPY_POLL_MAX
+    ):
+        self.client = client or get_client()
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jobs = []
+        self.condition = threading.Condition()
+        self.thread = None
+
+    # Track the copy operation behind the monitor URL
+    # Return a Future resolved with the resource ID of the copied item
+    def track(self, location, verify=True):
+        job = CopyJob(location, verify, self.min_interval)
+        with self.condition:
+            self.jobs.append(job)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self.run, name="copy-tracker", daemon=True
+                )
+                self.thread.start()
+            self.condition.notify()
+        return job.future
+
+    # Poll every in-flight copy operation when it is due
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.jobs:
+                    self.condition.wait()
+                now = time.monotonic()
+                due = [job for job in self.jobs if job.next_poll <= now]
+                if not due:
+                    next_poll = min(job.next_poll for job in self.jobs)
+                    self.condition.wait(next_poll - now)
+                    continue
+
+            for job in due:
+                try:
+                    done = job.context.run(self.poll, job)
+                except Exception as e:
+                    job.future.set_exception(e)
+                    done = True
+                if done:
+                    with self.condition:
+                        self.jobs.remove(job)
+
+    # Poll a copy operation once, return True when it has finished
+    def poll(self, job):
+        # The monitor URL is pre-authenticated, send no Authorization header
+        # Throttling is handled here, a client retry would stall the other jobs
+        try:
+            response = self.client.get(job.location, verify=job.verify, retries=0)
+        except requests.ConnectionError as e:
+            job.failures += 1
+            if job.failures > GRAPH_MAX_RETRIES:
+                raise
+            logging.warning("Monitor copy failed, poll again later. %s", e)
+            job.interval = min(self.max_interval, job.interval * COPY_POLL_BACKOFF)
+            job.next_poll = time.monotonic() + job.interval
+            return False
+        job.failures = 0
+        now = time.monotonic()
+        if response.status_code in RETRY_STATUSES:
+            job.interval = min(self.max_interval, job.interval * COPY_POLL_BACKOFF)
+            job.next_poll = now + self.retry_after(response, job.interval)
+            return False
+        if response.status_code >= 400:
+            logging.error(
+                "Monitor copy failed. %s %s", response.status_code, response.text
+            )
+            raise Exception("SharePoint copy operation failed.")
+
+        result = response.json()
+        status = result.get("status")
+        if status == "completed":
+            logging.info("Copy operation successful.")
+            job.future.set_result(result.get("resourceId"))
+            return True
+        elif status == "failed":
+            logging.error("Copy operation failed: %s", result.get("error"))
+            raise Exception("SharePoint copy operation failed.")
+
+        percentage = result.get("percentageComplete")
+        job.interval = self.next_interval(job, now, percentage)
+        job.next_poll = now + self.retry_after(response, job.interval)
+        return False
+
+    # Estimate the next poll interval from the copy progress,
+    # back off exponentially when there is no usable progress
+    def next_interval(self, job, now, percentage):
+        interval = job.interval * COPY_POLL_BACKOFF
+        if percentage is not None:
+            if job.sample is not None:
+                elapsed = now - job.sample[0]
+                progress = percentage - job.sample[1]
+                if progress > 0 and elapsed > 0:
+                    # Poll at half of the estimated remaining time
+                    remaining = (100 - percentage) * elapsed / progress
+                    interval = remaining / 2
+            job.sample = (now, percentage)
+        return max(self.min_interval, min(self.max_interval, interval))
+
+    # Honor the Retry-After header when the server sends one
+    def retry_after(self, response, default):
+        try:
+            return max(float(response.headers.get("Retry-After")), default)
+        except (TypeError, ValueError):
+            return default
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+# Get the process-wide copy tracker, create it on first use
+def get_tracker():
+    global _tracker
+    if _tracker is None:
+        with _tracker_lock:
+            if _tracker is None:
+                _tracker = CopyTracker()
+    return _tracker
@@ -1,16 +1,31 @@
+import os
 import logging
+import threading
+from dotenv import load_dotenv
 
 from model import Model
-from sharepoint import Sharepoint
+from sharepoint import Sharepoint, BATCH_LIMIT
+
+# Load environment variables from .env file
+load_dotenv()
+# Workbook sessions expire after about 5 minutes of inactivity
+WORKBOOK_SESSION_KEEPALIVE = int(os.getenv("WORKBOOK_SESSION_KEEPALIVE", "120"))
 
 
 class Form:
-    def __init__(self, access_token, spdir_parent, excel_name):
+    def __init__(self, access_token, spdir_parent, excel_name, name=None):
         self.access_token = access_token
         self.excel_name = excel_name
+        # Name of the form in the forms config, None for the single env form
+        self.name = name
         self.sp_parent = Sharepoint(access_token, spdir_parent, verify=False)
         self.sp_item_id = self.get_item_id()
         self.rows = []
+        # Workbook version handled by the last cycle, and seen by this cycle
+        self.tag = None
+        self.seen_tag = None
+        # Stops the keep-alive of the workbook session
+        self.session_closed = None
 
     # Get the item id of the excel file in the parent directory in SharePoint
     def get_item_id(self):
@@ -30,25 +45,120 @@ class Form:
             logging.error(f"Get Item ID of {self.excel_name} failed. {e}")
             raise
 
+    # Open a workbook session reused by every read and write of the cycle
+    # The session persists its changes, the write-back goes through it
+    # Work without a session if it cannot be created
+    def open_session(self):
+        try:
+            self.sp_parent.excel_create_session(self.sp_item_id, persist=True)
+        except Exception as e:
+            logging.warning(f"Open session of '{self.excel_name}' failed. {e}")
+            return
+
+        self.session_closed = threading.Event()
+        threading.Thread(
+            target=self.keep_session_alive,
+            args=(self.session_closed,),
+            name="workbook-session",
+            daemon=True,
+        ).start()
+
+    # Refresh the workbook session until it is closed
+    def keep_session_alive(self, closed):
+        while not closed.wait(WORKBOOK_SESSION_KEEPALIVE):
+            try:
+                self.sp_parent.excel_refresh_session(self.sp_item_id)
+            except Exception as e:
+                logging.warning(f"Refresh session of '{self.excel_name}' failed. {e}")
+
+    # Close the workbook session at the end of the cycle
+    def close_session(self):
+        if self.session_closed is None:
+            return
+        self.session_closed.set()
+        self.session_closed = None
+        try:
+            self.sp_parent.excel_close_session(self.sp_item_id)
+        except Exception as e:
+            logging.warning(f"Close session of '{self.excel_name}' failed. {e}")
+
+    # Get the version tag of the excel file content in SharePoint
+    def get_tag(self):
+        item = self.sp_parent.get_item(self.sp_item_id, select="cTag,eTag")
+        return item.get("cTag") or item.get("eTag")
+
+    # Check if the excel file changed since the last cycle
+    def changed(self):
+        try:
+            self.seen_tag = self.get_tag()
+            return self.seen_tag is None or self.seen_tag != self.tag
+        except Exception as e:
+            logging.error(f"Check changes of '{self.excel_name}' failed. {e}")
+            raise
+
+    # Remember the version of the excel file read by the cycle
+    # Edits made while the cycle ran are picked up by the next cycle, our own
+    # write-back costs one extra read since unchanged rows are not written again
+    def commit(self):
+        if any(row.valid and row.share_status == "Hata." for _, row in self.rows):
+            # Process the failed rows again in the next cycle
+            self.tag = None
+        else:
+            self.tag = self.seen_tag
+
+    # Check if the result of the row differs from the share columns in the sheet
+    # The share date alone does not count, Excel may store it as a date serial
+    @staticmethod
+    def modified(row):
+        url, _, status, error = (list(row.share_values) + [""] * 4)[:4]
+        written = (url, status, error)
+        result = (row.share_url, row.share_status, row.error)
+        return [str(value or "") for value in written] != [
+            str(value or "") for value in result
+        ]
+
     # Read the data from the excel file in SharePoint
+    # Stream the rows in blocks and skip the rows not pending before parsing
     def read(self, sheet_name):
         try:
-            rows = self.sp_parent.excel_read(self.sp_item_id, sheet_name, start_row=6)
-            logging.info(f"Read '{self.excel_name}' successfully.")
-            
+            # The Model columns start at column B, write-back uses columns V-Y
+            rows = self.sp_parent.excel_read_rows(
+                self.sp_item_id, sheet_name, start_row=6, col_start="B", col_end="Y"
+            )
+            self.rows = []
             for idx, item in rows:
-                row = Model(item)
+                if not Model.pending(item):
+                    continue
+                row = Model(item, form=self.name)
                 if row.valid or row.error:
                     self.rows.append((idx, row))
+            logging.info(f"Read '{self.excel_name}' successfully.")
             return self.rows
         except Exception as e:
             logging.error(f"Read '{self.excel_name}' failed. {e}")
             raise
 
     # Write the updated rows to the excel file in SharePoint
-    def write(self, sheet_name):
+    # Batched mode groups contiguous rows into range writes sent via Graph $batch
+    def write(self, sheet_name, batched=True):
         try:
-            for idx, row in self.rows:
+            rows = [(idx, row) for idx, row in self.rows if self.modified(row)]
+            if batched:
+                failed_rows = self.write_batched(sheet_name, rows)
+            else:
+                failed_rows = self.write_rows(sheet_name, rows)
+            if failed_rows:
+                raise Exception(f"Rows {failed_rows} could not be written.")
+            logging.info(f"Write to '{self.excel_name}' successfully.")
+        except Exception as e:
+            logging.error(f"Write to '{self.excel_name}' failed. {e}")
+            raise
+
+    # Write the given rows one by one, return the indexes of the failed rows
+    def write_rows(self, sheet_name, rows):
+        failed_rows = []
+        for idx, row in rows:
+            try:
                 values = [[row.share_url, row.share_date, row.share_status, row.error]]
                 self.sp_parent.excel_write_row(
                     self.sp_item_id,
@@ -58,7 +168,65 @@ class Form:
                     col_end="Y",
                     values=values,
                 )
-            logging.info(f"Write to '{self.excel_name}' successfully.")
-        except Exception as e:
-            logging.error(f"Write to '{self.excel_name}' failed. {e}")
-            raise
+            except Exception as e:
+                logging.error(f"Write row {idx} failed. {e}")
+                failed_rows.append(idx)
+        return failed_rows
+
+    # Group the rows into blocks of contiguous row indexes
+    def get_blocks(self, rows):
+        blocks = []
+        for idx, row in sorted(rows, key=lambda item: item[0]):
+            if blocks and blocks[-1][-1][0] == idx - 1:
+                blocks[-1].append((idx, row))
+            else:
+                blocks.append([(idx, row)])
+        return blocks
+
+    # Write the rows in contiguous blocks, BATCH_LIMIT blocks per Graph call
+    # Return the indexes of the rows that could not be written
+    def write_batched(self, sheet_name, rows):
+        blocks = self.get_blocks(rows)
+        failed_blocks = []
+        for start in range(0, len(blocks), BATCH_LIMIT):
+            chunk = blocks[start : start + BATCH_LIMIT]
+            requests = []
+            for i, block in enumerate(chunk):
+                request = self.sp_parent.excel_write_request(
+                    self.sp_item_id,
+                    sheet_name,
+                    row_start=block[0][0],
+                    row_end=block[-1][0],
+                    col_start="V",
+                    col_end="Y",
+                    values=[
+                        [row.share_url, row.share_date, row.share_status, row.error]
+                        for _, row in block
+                    ],
+                )
+                request["id"] = str(i)
+                # Workbook writes must not run in parallel, chain the sub-requests
+                if i > 0:
+                    request["dependsOn"] = [str(i - 1)]
+                requests.append(request)
+
+            # A failed batch leaves its blocks to the row by row fallback
+            try:
+                responses = self.sp_parent.batch(requests, endpoint="workbook")
+            except Exception as e:
+                logging.error(f"Write batch of {len(chunk)} blocks failed. {e}")
+                failed_blocks.extend(chunk)
+                continue
+            for i, block in enumerate(chunk):
+                status = responses.get(str(i), {}).get("status", 500)
+                if status >= 400:
+                    logging.error(
+                        f"Write rows {block[0][0]}-{block[-1][0]} failed. {status}"
+                    )
+                    failed_blocks.append(block)
+
+        # Retry the failed blocks row by row to report the failure of each row
+        failed_rows = []
+        for block in failed_blocks:
+            failed_rows.extend(self.write_rows(sheet_name, block))
+        return failed_rows
@@ -0,0 +1,197 @@
+import os
+import time
+import random
+import logging
+import threading
+import requests
+from collections import Counter
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from dotenv import load_dotenv
+
+from metrics import metrics
+
+# Load environment variables from .env file
+load_dotenv()
+GRAPH_BASE_URL = os.getenv("GRAPH_BASE_URL", "https://graph.microsoft.com/v1.0")
+GRAPH_POOL_SIZE = int(os.getenv("GRAPH_POOL_SIZE", "20"))
+GRAPH_MAX_RETRIES = int(os.getenv("GRAPH_MAX_RETRIES", "5"))
+GRAPH_BACKOFF = float(os.getenv("GRAPH_BACKOFF", "1"))
+GRAPH_BACKOFF_MAX = float(os.getenv("GRAPH_BACKOFF_MAX", "60"))
+# Requests per second allowed for each endpoint class
+GRAPH_RATES = {
+    "workbook": float(os.getenv("GRAPH_RATE_WORKBOOK", "5")),
+    "drive": float(os.getenv("GRAPH_RATE_DRIVE", "20")),
+    "mail": float(os.getenv("GRAPH_RATE_MAIL", "4")),
+}
+RETRY_STATUSES = (429, 503, 504)
+# Methods safe to send again when Graph may already have handled the request
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "PATCH", "DELETE")
+# Maximum number of sub-requests in a single Graph $batch request
+BATCH_LIMIT = 20
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    # Block until a request is allowed
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    # Stop every request of the bucket for the given seconds
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class GraphClient:
+    def __init__(self, base_url=GRAPH_BASE_URL, pool_size=GRAPH_POOL_SIZE):
+        self.base_url = base_url.rstrip("/")
+
+        # Keep-alive connection pool shared by every request of the process
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # Rate limit per endpoint class, and throttling counters
+        self.buckets = {name: TokenBucket(rate) for name, rate in GRAPH_RATES.items()}
+        self.stats = Counter()
+        self.stats_lock = threading.Lock()
+
+        # Headers shared by every Graph request
+        self.session.headers.update(
+            {
+                "Accept": "application/json",
+                "Accept-Encoding": "gzip, deflate",
+                "Content-Type": "application/json",
+            }
+        )
+
+    # Get the endpoint class of the URL for rate limiting
+    def endpoint(self, url):
+        if "/workbook/" in url:
+            return "workbook"
+        if url.endswith("/sendMail"):
+            return "mail"
+        return "drive"
+
+    def count(self, endpoint, name):
+        with self.stats_lock:
+            self.stats[f"{endpoint}.{name}"] += 1
+        metrics.inc(f"graph_{name}_total", endpoint=endpoint)
+
+    # Send a request through the pooled session
+    # Wait for the rate limit and retry throttled or unavailable responses
+    # A request that may have reached Graph (a dropped connection, a 503/504)
+    # is only retried when it is idempotent, POST callers opt in if it is safe
+    def request(
+        self,
+        method,
+        url,
+        endpoint=None,
+        retries=GRAPH_MAX_RETRIES,
+        idempotent=None,
+        **kwargs,
+    ):
+        endpoint = endpoint or self.endpoint(url)
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        bucket = self.buckets[endpoint]
+        attempt = 0
+        while True:
+            bucket.acquire()
+            self.count(endpoint, "requests")
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.ConnectionError as e:
+                metrics.inc("graph_responses_total", endpoint=endpoint, status="error")
+                if attempt >= retries or not (idempotent or self.not_sent(e)):
+                    raise
+                response = None
+            else:
+                metrics.observe(
+                    "graph_request_seconds",
+                    time.perf_counter() - start,
+                    endpoint=endpoint,
+                    method=method,
+                )
+                metrics.inc(
+                    "graph_responses_total",
+                    endpoint=endpoint,
+                    status=response.status_code,
+                )
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                if response.status_code == 429:
+                    self.count(endpoint, "throttled")
+                elif not idempotent:
+                    return response
+                if attempt >= retries:
+                    return response
+
+            # Exponential backoff with full jitter unless the server asks for a delay
+            backoff = min(GRAPH_BACKOFF_MAX, GRAPH_BACKOFF * 2**attempt)
+            delay = random.uniform(0, backoff)
+            retry_after = None
+            if response is not None:
+                retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                delay = float(retry_after) + random.uniform(0, GRAPH_BACKOFF)
+                bucket.pause(delay)
+            status = "connection error" if response is None else response.status_code
+            logging.warning(
+                "Graph %s %s got %s, retry in %.1fs.", method, endpoint, status, delay
+            )
+            self.count(endpoint, "retries")
+            attempt += 1
+            time.sleep(delay)
+
+    # Check if the connection failed before the request was sent
+    @staticmethod
+    def not_sent(error):
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+# Get the process-wide Graph client, create it on first use
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = GraphClient()
+    return _client
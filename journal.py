@@ -0,0 +1,96 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+JOURNAL_PATH = os.getenv(
+    "JOURNAL_PATH", os.path.join(os.path.dirname(__file__), "journal.db")
+)
+
+# Steps of a row in processing order
+STEPS = ("copied", "shared", "inventoried", "mailed", "recorded")
+
+
+class Journal:
+    def __init__(self, path=JOURNAL_PATH):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    row_idx INTEGER NOT NULL,
+                    row_hash TEXT NOT NULL,
+                    step TEXT NOT NULL,
+                    dest_name TEXT,
+                    dest_item_id TEXT,
+                    share_url TEXT,
+                    files TEXT,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (row_idx, row_hash)
+                )
+                """
+            )
+
+    # Get the progress of the row, None if the row has no unfinished job
+    def get(self, row_idx, row_hash):
+        with self.lock:
+            job = self.conn.execute(
+                "SELECT * FROM jobs WHERE row_idx = ? AND row_hash = ?",
+                (row_idx, row_hash),
+            ).fetchone()
+        # A recorded job is finished, the row is requested again
+        if job is None or job["step"] == "recorded":
+            return None
+        job = dict(job)
+        job["files"] = json.loads(job["files"]) if job["files"] else None
+        return job
+
+    # Save the step reached by the row with the results of the step
+    def update(self, row_idx, row_hash, step, **fields):
+        if "files" in fields:
+            fields["files"] = json.dumps(fields["files"])
+        fields["step"] = step
+        fields["updated_at"] = datetime.now().isoformat()
+        columns = ", ".join(fields)
+        placeholders = ", ".join("?" for _ in fields)
+        updates = ", ".join(f"{column} = excluded.{column}" for column in fields)
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"INSERT INTO jobs (row_idx, row_hash, {columns}) "
+                f"VALUES (?, ?, {placeholders}) "
+                f"ON CONFLICT (row_idx, row_hash) DO UPDATE SET {updates}",
+                (row_idx, row_hash, *fields.values()),
+            )
+        logging.debug("Journal row %s reached step '%s'.", row_idx, step)
+
+    # Remove every job from the journal
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM jobs")
+
+
+# Check if the job already reached the step
+def reached(job, step):
+    return job is not None and STEPS.index(job["step"]) >= STEPS.index(step)
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+# Get the process-wide journal, open it on first use
+def get_journal():
+    global _journal
+    if _journal is None:
+        with _journal_lock:
+            if _journal is None:
+                _journal = Journal()
+    return _journal
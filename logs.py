@@ -0,0 +1,117 @@
+import os
+import copy
+import json
+import queue
+import atexit
+import logging
+from contextlib import contextmanager
+from logging.handlers import (
+    QueueHandler,
+    QueueListener,
+    RotatingFileHandler,
+    TimedRotatingFileHandler,
+)
+from dotenv import load_dotenv
+
+from metrics import metrics, current_cycle, current_row
+
+# Load environment variables from .env file
+load_dotenv()
+LOG_PATH = os.getenv("LOG_PATH", os.path.join(os.path.dirname(__file__), "app.log"))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# "json" writes one JSON record per line to the log file, "text" the plain format
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+# Rotate by time instead of size, e.g. "midnight" or "H"
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN")
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "5"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+# Tag the log records of the current context with the row
+@contextmanager
+def row_context(row):
+    token = current_row.set(row)
+    try:
+        yield
+    finally:
+        current_row.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    # Copy the cycle and row of the calling thread to the record
+    def filter(self, record):
+        cycle = current_cycle.get()
+        record.cycle_id = cycle["cycle_id"] if cycle else None
+        record.form = cycle["form"] if cycle else None
+        record.row = current_row.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "cycle_id": getattr(record, "cycle_id", None),
+            "form": getattr(record, "form", None),
+            "row": getattr(record, "row", None),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class LogQueueHandler(QueueHandler):
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    # Only merge the arguments into the message, the listener formats the record
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    # Never block the caller, drop the record when the writer falls behind
+    # The dropped records are counted in the logs_dropped_total metric
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            metrics.inc("logs_dropped_total", level=record.levelname)
+
+
+# Log through a queue, a background thread writes the records to the
+# rotating log file and the console
+def setup_logging(path=LOG_PATH, level=LOG_LEVEL):
+    if LOG_ROTATE_WHEN:
+        file_handler = TimedRotatingFileHandler(
+            path, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUPS, encoding="utf-8"
+        )
+    else:
+        file_handler = RotatingFileHandler(
+            path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8"
+        )
+    if LOG_FORMAT == "json":
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = LogQueueHandler(log_queue)
+    handler.addFilter(ContextFilter())
+    logging.basicConfig(level=level, handlers=[handler])
+
+    listener = QueueListener(log_queue, file_handler, stream_handler)
+    listener.start()
+    # Write the queued records before the process exits
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,148 @@
+import os
+import time
+import logging
+import threading
+from string import Template
+from dotenv import load_dotenv
+
+from graph import BATCH_LIMIT, GRAPH_BACKOFF, GRAPH_MAX_RETRIES
+
+# Load environment variables from .env file
+load_dotenv()
+# Files listed in the mail body, the rest are only counted
+MAIL_MAX_FILES = int(os.getenv("MAIL_MAX_FILES", "200"))
+
+# Mail body compiled once for every message
+MAIL_TEMPLATE = Template(
+    """
+                    <p>Merhaba $sp_r,</p>
+                    <p>Aşağıdaki linkte, $sp Firması için ... A.Ş tarafından $dest_name dosyası erişiminize açılmıştır.</p>
+                    <p><b>OEM:</b> $oem</p>
+                    <p><b>Project:</b> $project</p>
+                    <p><b>System:</b> $system</p>
+                    <p><b>Part Name:</b> $partname</p>
+                    <p><b>Part Number:</b> $partno</p>
+                    <p><b>Link:</b><br><a href="$share_url">$dest_name</a></p>
+                    <p><b>Dosya içeriği:</b><br>$file_list</p>
+                    <p><b>Yorum / Talep:</b></p>
+                    <p><b>$comment</b></p>
+                    <p><b>Firma Sorumlusu:</b> $r</p>
+                    <p>İyi çalışmalar.</p>
+                    """
+)
+
+
+# Generate the file listing with names and sizes
+def build_file_list(files, max_files=MAIL_MAX_FILES):
+    lines = [
+        f"{idx}-{name}<br>Dosya boyutu: {size}<br>"
+        for idx, (name, size) in enumerate(files[:max_files], start=1)
+    ]
+    if len(files) > max_files:
+        lines.append(f"... ve {len(files) - max_files} dosya daha.<br>")
+    return "".join(lines)
+
+
+# Build the sendMail message of the row
+def build_message(data, dest_name, files):
+    content = MAIL_TEMPLATE.substitute(
+        sp_r=data.sp_r,
+        sp=data.sp,
+        dest_name=dest_name,
+        oem=data.oem,
+        project=data.project,
+        system=data.system,
+        partname=data.partname,
+        partno=data.partno,
+        share_url=data.share_url,
+        file_list=build_file_list(files),
+        comment=data.comment,
+        r=data.r,
+    )
+    return {
+        "message": {
+            "subject": f"RPABAY_DATA_PAYLASIMI_{data.sp}_{data.subject}",
+            "body": {"contentType": "HTML", "content": content},
+            "toRecipients": [{"emailAddress": {"address": data.sp_r_email}}],
+            "ccRecipients": [{"emailAddress": {"address": data.r_email}}]
+            + [{"emailAddress": {"address": cc}} for cc in data.r_cc_email],
+        }
+    }
+
+
+class MailDispatcher:
+    def __init__(self, sp):
+        # Any Sharepoint object, used to send the $batch requests
+        self.sp = sp
+        self.queue = []
+        self.lock = threading.Lock()
+
+    # Queue the mail of the row, the key identifies the row in the results
+    def enqueue(self, key, data, dest_name, files):
+        message = build_message(data, dest_name, files)
+        with self.lock:
+            self.queue.append((key, data.sp_r_email, message))
+
+    # Send the queued mails in $batch requests of BATCH_LIMIT mails
+    # Throttled (429) mails are sent again in the next round
+    # Return the error of each key, None if the mail is sent
+    def flush(self):
+        with self.lock:
+            queue, self.queue = self.queue, []
+
+        results = {}
+        attempt = 0
+        while queue:
+            retry, delay = [], 0
+            for start in range(0, len(queue), BATCH_LIMIT):
+                chunk = queue[start : start + BATCH_LIMIT]
+                requests = [
+                    {
+                        "id": str(i),
+                        "method": "POST",
+                        "url": "/me/sendMail",
+                        "headers": {"Content-Type": "application/json"},
+                        "body": message,
+                    }
+                    for i, (_, _, message) in enumerate(chunk)
+                ]
+                try:
+                    responses = self.sp.batch(requests, endpoint="mail")
+                except Exception as e:
+                    for key, _, _ in chunk:
+                        results[key] = e
+                    continue
+
+                for i, item in enumerate(chunk):
+                    key, email, _ = item
+                    response = responses.get(str(i), {})
+                    status = response.get("status", 500)
+                    # A 503/504 mail may have been delivered, only 429 is resent
+                    if status == 429 and attempt < GRAPH_MAX_RETRIES:
+                        retry.append(item)
+                        delay = max(delay, self.retry_after(response, attempt))
+                    elif status >= 400:
+                        logging.error(
+                            "Send email failed. %s %s", status, response.get("body")
+                        )
+                        results[key] = Exception("Failed to send email.")
+                    else:
+                        logging.info("Send email to %s successfully.", email)
+                        results[key] = None
+
+            queue = retry
+            if queue:
+                logging.warning(
+                    "%d mails throttled, retry in %.1fs.", len(queue), delay
+                )
+                time.sleep(delay)
+                attempt += 1
+        return results
+
+    # Get the delay before sending a throttled mail again
+    def retry_after(self, response, attempt):
+        headers = response.get("headers") or {}
+        try:
+            return float(headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            return GRAPH_BACKOFF * 2**attempt
@@ -1,12 +1,22 @@
 import os
+import json
 import time
 import logging
+import threading
 from datetime import datetime
 from dotenv import load_dotenv
 
 from sharepoint import Sharepoint
 from form import Form
-from auth import get_access_token
+from auth import get_token_provider
+from trigger import Trigger, TRIGGER_PORT
+from journal import get_journal, reached
+from mailer import MailDispatcher
+from metrics import metrics, start_server, METRICS_PORT
+from pipeline import Pipeline, Stage
+from graph import BATCH_LIMIT
+from scheduler import Scheduler
+from logs import setup_logging, row_context
 
 # Load environment variables from .env file
 load_dotenv()
@@ -15,98 +25,393 @@ EXCEL_NAME = os.getenv("RPABAY_DATA_MANAGEMENT_REQUEST_FORM")
 SHEET_NAME = os.getenv("RPABAY_DATA_MANAGEMENT_REQUEST_FORM_SHEET")
 SPDIR_BASE = os.getenv("RPABAY_DATA_MANAGEMENT")
 SPDIR_SENT = os.getenv("RPABAY_DATA_GIDEN")
+WORKERS = int(os.getenv("WORKERS", "4"))
+COMPANY_WORKERS = int(os.getenv("COMPANY_WORKERS", "1"))
+# Workers of each pipeline stage, e.g. "copy=8,share=4"
+STAGE_WORKERS = {
+    "resolve": 2,
+    "copy": WORKERS,
+    "share": 4,
+    "inventory": 4,
+    "mail": 1,
+    "record": 1,
+}
+for item in filter(None, os.getenv("STAGE_WORKERS", "").split(",")):
+    name, workers = item.split("=")
+    STAGE_WORKERS[name.strip()] = int(workers)
+STAGE_QUEUE_SIZE = int(os.getenv("STAGE_QUEUE_SIZE", "100"))
+# JSON list of the forms to process, the env form is used when not set
+FORMS_CONFIG = os.getenv("FORMS_CONFIG")
 
-# Configure logging
-log_file = os.path.join(os.path.dirname(__file__), "app.log")
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[logging.FileHandler(log_file), logging.StreamHandler()],
-)
+# The single form configured in the env
+ENV_FORM = {
+    "name": None,
+    "workbook": EXCEL_NAME,
+    "sheet": SHEET_NAME,
+    "base_dir": SPDIR_BASE,
+    "sent_dir": SPDIR_SENT,
+    "frequency": FREQUENCY,
+}
 
+# Concurrency limits per company folder
+company_locks = {}
+company_locks_guard = threading.Lock()
 
-def main(access_token):
-    try:
-        # STEP 1: Read excel file from SharePoint
-        request_form = Form(
-            access_token, spdir_parent=SPDIR_BASE, excel_name=EXCEL_NAME
-        )
-        request_form.read(SHEET_NAME)
+# Configure logging, the records are written by a background thread
+setup_logging()
+
+
+# Load the forms from the config file, the missing keys default to the env form
+def load_forms(path=FORMS_CONFIG):
+    if not path:
+        return [ENV_FORM]
+    with open(path, encoding="utf-8") as f:
+        forms = [{**ENV_FORM, **form} for form in json.load(f)]
+
+    names = [form["name"] for form in forms]
+    if None in names or len(set(names)) != len(names):
+        logging.error(f"Forms in '{path}' need unique names: {names}")
+        raise Exception("Invalid forms config.")
+    return forms
+
+
+# Lock the rows sent to the same company folder so they do not race
+def get_company_lock(company):
+    with company_locks_guard:
+        if company not in company_locks:
+            company_locks[company] = threading.BoundedSemaphore(COMPANY_WORKERS)
+        return company_locks[company]
 
-        for index, (idx, row) in enumerate(request_form.rows):
+
+class Group:
+    def __init__(self, rows):
+        # Rows of the group still in progress, failed rows are removed
+        self.rows = rows
+        self.sp_src = None
+        self.sp_dest = None
+        self.dest_name = None
+        self.dest_item_id = None
+        self.files = None
+
+    @property
+    def indexes(self):
+        return [idx for idx, _ in self.rows]
+
+    # Write the error to the rows of the group, nothing is left in progress
+    def fail(self, e):
+        for _, row in self.rows:
+            set_error(row, e)
+        self.rows = []
+
+
+# Group the rows copying the same source to the same company folder
+def plan(rows):
+    groups = {}
+    for idx, row in rows:
+        # Rows with an error are not copied, keep them alone
+        key = ("error", idx) if row.error else (row.url, row.sp)
+        groups.setdefault(key, []).append((idx, row))
+    return [Group(group) for group in groups.values()]
+
+
+# Run the step on each group, keep the groups with rows still in progress
+def run_step(groups, step):
+    result = []
+    for group in groups:
+        with row_context(group.indexes):
             try:
-                logging.info(f"|-------> ROW {idx} <-------|")
-
-                # Skip the row if there is an error
-                if row.error:
-                    raise Exception(row.error)
-
-                # STEP 2: Initialize the source & destination Sharepoint objects
-                sp_src = Sharepoint(access_token, row.url, verify=False)
-                sp_dest = Sharepoint(access_token, SPDIR_SENT, verify=False)
-
-                # STEP 3: Copy the source folder to the destination in Sharepoint
-                timestamp = datetime.now().strftime("%Y%m%d%H%M")
-                dest_name = f"{timestamp}_{row.oem}_{row.project}_{row.partname}"
-                dest_item_id = sp_src.copy(
-                    sp_dest.drive_id,
-                    sp_dest.item_id,
-                    company=row.sp,
-                    dest_name=dest_name,
-                )
-
-                # STEP 4: Share the destination Sharepoint link with the supplier responsible
-                share_url = sp_dest.share(
-                    dest_item_id, [row.sp_r_email, row.r_email, *row.r_cc_email]
-                )
-                row.share_url = share_url
-
-                # STEP 5: Send mail to the supplier responsible
-                files = sp_dest.get_file_details(dest_item_id)
-                sp_dest.send_email(row, dest_name, files)
-
-                # Write result to row (SUCCESS)
-                row.share_status = "Gönderildi."
-                row.error = ""
-                logging.info(f"COMPLETED ({row.sp} - {row.sp_r_email})")
+                step(group)
             except Exception as e:
-                # Write result to row (ERROR)
-                row.share_status = "Hata."
-                row.error = str(e)
-                logging.error(f"{e}")
-            finally:
-                # Write result to row
-                row.share_date = datetime.now().strftime("%d.%m.%Y")
-                request_form.rows[index] = (idx, row)
-
-        # STEP 6: Write the updated rows to SharePoint
-        request_form.write(SHEET_NAME)
+                group.fail(e)
+        if group.rows:
+            result.append(group)
+    return result
+
+
+# STEP 2: Initialize the source & destination Sharepoint objects
+def resolve(access_token, sent_dir, group):
+    for idx, row in group.rows:
+        logging.info("|-------> ROW %s <-------|", idx)
+
+    # Skip the row if there is an error
+    _, first = group.rows[0]
+    if first.error:
+        raise Exception(first.error)
+
+    journal = get_journal()
+    group.sp_dest = Sharepoint(access_token, sent_dir, verify=False)
+    for idx, row in group.rows:
+        job = journal.get(idx, row.hash)
+        if reached(job, "copied"):
+            # Reuse the copy of a previous run
+            logging.info("Resume row %s after step '%s'.", idx, job["step"])
+            group.dest_name, group.dest_item_id = job["dest_name"], job["dest_item_id"]
+            return
+    group.sp_src = Sharepoint(access_token, first.url, verify=False)
+
+
+# STEP 3: Copy the source folder to the destination in Sharepoint
+def copy(group):
+    _, first = group.rows[0]
+    if group.dest_item_id is None:
+        company = (group.sp_dest.sp_url, first.sp)
+        with get_company_lock(company), metrics.timed("copy", rows=group.indexes):
+            timestamp = datetime.now().strftime("%Y%m%d%H%M")
+            dest_name = f"{timestamp}_{first.oem}_{first.project}_{first.partname}"
+            group.dest_item_id = group.sp_src.copy(
+                group.sp_dest.drive_id,
+                group.sp_dest.item_id,
+                company=first.sp,
+                dest_name=dest_name,
+            )
+            group.dest_name = dest_name
+
+    journal = get_journal()
+    for idx, row in group.rows:
+        if not reached(journal.get(idx, row.hash), "copied"):
+            journal.update(
+                idx,
+                row.hash,
+                "copied",
+                dest_name=group.dest_name,
+                dest_item_id=group.dest_item_id,
+            )
+
+
+# STEP 4: Share the destination Sharepoint link with the supplier responsible
+# A failing row does not stop the other rows of the group
+def share(group):
+    journal = get_journal()
+    rows = []
+    for idx, row in group.rows:
+        try:
+            with row_context(idx):
+                job = journal.get(idx, row.hash)
+                if not reached(job, "shared"):
+                    with metrics.timed("share", rows=[idx]):
+                        share_url = group.sp_dest.share(
+                            group.dest_item_id,
+                            [row.sp_r_email, row.r_email, *row.r_cc_email],
+                        )
+                    journal.update(idx, row.hash, "shared", share_url=share_url)
+                    job = journal.get(idx, row.hash)
+            row.share_url = job["share_url"]
+            rows.append((idx, row))
+        except Exception as e:
+            set_error(row, e)
+    group.rows = rows
+
+
+# STEP 5: List the files of the copy once for the rows of the group
+def inventory(group):
+    journal = get_journal()
+    for idx, row in group.rows:
+        job = journal.get(idx, row.hash)
+        if reached(job, "inventoried"):
+            group.files = job["files"]
+            continue
+        if group.files is None:
+            with metrics.timed("get_file_details", rows=group.indexes):
+                group.files = group.sp_dest.get_file_details(group.dest_item_id)
+        journal.update(idx, row.hash, "inventoried", files=group.files)
+
+
+# STEP 6: Send the mails of the groups in batches, drop the rows that failed
+# Return the groups with rows still in progress
+def mail(sp, groups):
+    journal = get_journal()
+    mailer = MailDispatcher(sp)
+    rows = {}
+    for group in groups:
+        for idx, row in group.rows:
+            if not reached(journal.get(idx, row.hash), "mailed"):
+                mailer.enqueue(idx, row, group.dest_name, group.files)
+                rows[idx] = row
+
+    with metrics.timed("send_email", rows=list(rows)):
+        results = mailer.flush()
+    for idx, error in results.items():
+        if error is None:
+            journal.update(idx, rows[idx].hash, "mailed")
+        else:
+            set_error(rows[idx], error)
+    for group in groups:
+        group.rows = [(idx, row) for idx, row in group.rows if results.get(idx) is None]
+    return [group for group in groups if group.rows]
+
+
+# STEP 7: Write the result of the rows that made it through every step
+def record(group):
+    for _, row in group.rows:
+        set_success(row)
+
+
+# Write the error to the rows of the groups a stage failed on
+def fail_groups(groups, e):
+    for group in groups:
+        group.fail(e)
+
+
+# Process the rows in stages connected by bounded queues,
+# so different groups can be in different stages at the same time
+def process(access_token, sp, rows, sent_dir):
+    steps = {
+        "resolve": lambda group: resolve(access_token, sent_dir, group),
+        "copy": copy,
+        "share": share,
+        "inventory": inventory,
+    }
+    stages = [
+        Stage(
+            name,
+            lambda groups, step=step: run_step(groups, step),
+            workers=STAGE_WORKERS[name],
+            on_error=fail_groups,
+        )
+        for name, step in steps.items()
+    ]
+    # The mails of several groups are sent together in $batch requests
+    stages.append(
+        Stage(
+            "mail",
+            lambda groups: mail(sp, groups),
+            workers=STAGE_WORKERS["mail"],
+            batch_size=BATCH_LIMIT,
+            on_error=fail_groups,
+        )
+    )
+    stages.append(
+        Stage(
+            "record",
+            lambda groups: run_step(groups, record),
+            workers=STAGE_WORKERS["record"],
+            on_error=fail_groups,
+        )
+    )
+    Pipeline(stages, queue_size=STAGE_QUEUE_SIZE).run(plan(rows))
+
+
+# Write result to row (SUCCESS)
+def set_success(row):
+    row.share_status = "Gönderildi."
+    row.error = ""
+    row.share_date = datetime.now().strftime("%d.%m.%Y")
+    metrics.inc("rows_total", status="sent")
+    logging.info("COMPLETED (%s - %s)", row.sp, row.sp_r_email)
+
+
+# Write result to row (ERROR)
+def set_error(row, e):
+    row.share_status = "Hata."
+    row.error = str(e)
+    row.share_date = datetime.now().strftime("%d.%m.%Y")
+    metrics.inc("rows_total", status="error")
+    logging.error("%s", e)
+
+
+# Run a cycle on the request form, return the form to reuse in the next cycle
+def main(access_token, request_form=None, config=ENV_FORM):
+    try:
+        # STEP 1: Read excel file from SharePoint
+        if request_form is None:
+            request_form = Form(
+                access_token,
+                spdir_parent=config["base_dir"],
+                excel_name=config["workbook"],
+                name=config["name"],
+            )
+
+        # Skip the cycle if nobody changed the excel file since the last cycle
+        with metrics.timed("change_check"):
+            changed = request_form.changed()
+        if not changed:
+            logging.info(f"No changes in '{config['workbook']}'.")
+            return request_form
+
+        # Reuse one workbook session for the reads and writes of the cycle
+        request_form.open_session()
+        try:
+            with metrics.timed("excel_read"):
+                request_form.read(config["sheet"])
+
+            # Process the rows in a staged pipeline, the rows are updated in place
+            process(
+                access_token,
+                request_form.sp_parent,
+                request_form.rows,
+                config["sent_dir"],
+            )
+
+            # STEP 8: Write the updated rows to SharePoint
+            with metrics.timed("excel_write"):
+                request_form.write(config["sheet"])
+
+            # The sent rows are written back, finish their jobs in the journal
+            journal = get_journal()
+            for idx, row in request_form.rows:
+                if row.share_status == "Gönderildi.":
+                    journal.update(idx, row.hash, "recorded")
+        finally:
+            request_form.close_session()
+        # Keep the version read before the cycle, edits made meanwhile are
+        # picked up by the next cycle
+        request_form.commit()
+        return request_form
 
     except Exception as e:
         logging.error(f"{e}")
+        # Resolve the form again in the next cycle
+        return None
+
+
+# Run a cycle of the form, keep its request form for the next cycle
+def run_cycle(access_token, config, request_forms):
+    name = config["name"] or config["workbook"]
+    start_time = time.time()
+    logging.info("=============================START=============================")
+    logging.info(f"Form: {name}")
+
+    metrics.start_cycle(datetime.now().strftime("%Y%m%d%H%M%S"), form=name)
+    request_forms[name] = main(access_token, request_forms.get(name), config)
+    summary = metrics.end_cycle()
+    logging.info(f"Step times of '{name}': {json.dumps(summary['steps'])}")
+
+    elapsed_time = time.time() - start_time
+    logging.info(f"Elapsed time: {elapsed_time:.2f} seconds")
+    logging.info(f"Waiting for {config['frequency']} seconds...")
+    logging.info("==============================END==============================")
 
 
 if __name__ == "__main__":
     try:
-        # Authentication
-        access_token = get_access_token()
+        # Authentication, the provider refreshes the token in the background
+        # The token, the HTTP pool and the caches are shared by every form
+        access_token = get_token_provider()
+        request_forms = {}
 
-        while True:
-            start_time = time.time()
-            logging.info(
-                "=============================START============================="
+        # Run the cycles of the forms fairly on a few workers
+        scheduler = Scheduler()
+        for config in load_forms():
+            scheduler.add(
+                config["name"] or config["workbook"],
+                config["frequency"],
+                lambda config=config: run_cycle(access_token, config, request_forms),
             )
 
-            main(access_token)
+        # Start the cycles on change notifications, keep polling as a fallback
+        if TRIGGER_PORT:
+            trigger = Trigger().start()
 
-            end_time = time.time()
-            elapsed_time = end_time - start_time
-            logging.info(f"Elapsed time: {elapsed_time:.2f} seconds")
-            logging.info(f"Waiting for {FREQUENCY} seconds...")
-            logging.info(
-                "==============================END=============================="
-            )
-            time.sleep(FREQUENCY)
+            def wake_on_notification():
+                while True:
+                    trigger.wait(None)
+                    scheduler.wake()
+
+            threading.Thread(target=wake_on_notification, daemon=True).start()
+        if METRICS_PORT:
+            start_server()
+
+        scheduler.run()
 
     except Exception as e:
         logging.critical(f"{e}")
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_SUMMARY_PATH = os.getenv("METRICS_SUMMARY_PATH")
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Summary of the cycle running in the current context, cycles of several
+# forms run at the same time, threads started by a cycle copy the context
+current_cycle = contextvars.ContextVar("current_cycle", default=None)
+# Row index (or indexes of a row group) handled in the current context
+current_row = contextvars.ContextVar("current_row", default=None)
+
+
+# Key of the metric, label values are strings so the keys always sort
+def metric_key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) -> Histogram or count, labels are sorted (key, value) tuples
+        self.histograms = {}
+        self.counters = {}
+        # Summary of the last cycle of each form
+        self.last_cycles = {}
+
+    # Record a latency in the histogram of the name and labels
+    def observe(self, name, value, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+            cycle = current_cycle.get()
+            if cycle is not None and name == "step_seconds":
+                step = cycle["steps"].setdefault(
+                    labels["step"], {"count": 0, "seconds": 0.0}
+                )
+                step["count"] += 1
+                step["seconds"] += value
+
+    # Increase the counter of the name and labels
+    # Graph counters are also added to the rows handled in the current context
+    def inc(self, name, value=1, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            cycle = current_cycle.get()
+            if cycle is not None:
+                label = ",".join(f"{k}={v}" for k, v in key[1])
+                counter = f"{name}{{{label}}}" if label else name
+                counters = cycle["counters"]
+                counters[counter] = counters.get(counter, 0) + value
+
+                row = current_row.get()
+                if row is not None and name.startswith("graph_"):
+                    for idx in row if isinstance(row, list) else [row]:
+                        steps = cycle["rows"].setdefault(str(idx), {})
+                        calls = steps.setdefault("graph", {})
+                        calls[counter] = calls.get(counter, 0) + value
+
+    # Time the step, the duration is also added to the given rows of the cycle
+    @contextmanager
+    def timed(self, step, rows=()):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe("step_seconds", elapsed, step=step)
+            cycle = current_cycle.get()
+            with self.lock:
+                if cycle is not None:
+                    for row in rows:
+                        steps = cycle["rows"].setdefault(str(row), {})
+                        steps[step] = round(steps.get(step, 0) + elapsed, 3)
+
+    # Start collecting the summary of a cycle of the form in the current context
+    def start_cycle(self, cycle_id, form=None):
+        current_cycle.set(
+            {
+                "cycle_id": cycle_id,
+                "form": form,
+                "started": time.time(),
+                "steps": {},
+                "counters": {},
+                "rows": {},
+            }
+        )
+
+    # Finish the cycle of the current context, save and return its summary
+    def end_cycle(self):
+        summary = current_cycle.get()
+        if summary is None:
+            return None
+        current_cycle.set(None)
+        with self.lock:
+            summary["seconds"] = round(time.time() - summary["started"], 3)
+            for step in summary["steps"].values():
+                step["seconds"] = round(step["seconds"], 3)
+            self.last_cycles[summary["form"]] = summary
+
+        if METRICS_SUMMARY_PATH:
+            try:
+                with open(METRICS_SUMMARY_PATH, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(summary) + "\n")
+            except Exception as e:
+                logging.warning(f"Save cycle summary failed. {e}")
+        return summary
+
+    # Render the metrics in the Prometheus text format
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE rpabay_{name} histogram")
+                for (key, labels), histogram in sorted(self.histograms.items()):
+                    if key != name:
+                        continue
+                    label = "".join(f'{k}="{v}",' for k, v in labels)
+                    for bound, count in zip(BUCKETS, histogram.buckets):
+                        lines.append(
+                            f'rpabay_{name}_bucket{{{label}le="{bound}"}} {count}'
+                        )
+                    lines.append(
+                        f'rpabay_{name}_bucket{{{label}le="+Inf"}} {histogram.count}'
+                    )
+                    label = "{" + label.rstrip(",") + "}" if label else ""
+                    lines.append(f"rpabay_{name}_sum{label} {histogram.sum:.6f}")
+                    lines.append(f"rpabay_{name}_count{label} {histogram.count}")
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE rpabay_{name} counter")
+                for (key, labels), count in sorted(self.counters.items()):
+                    if key != name:
+                        continue
+                    label = ",".join(f'{k}="{v}"' for k, v in labels)
+                    label = "{" + label + "}" if label else ""
+                    lines.append(f"rpabay_{name}{label} {count}")
+        return "\n".join(lines) + "\n"
+
+    # Get the metrics as a JSON serializable dict
+    def snapshot(self):
+        with self.lock:
+            return {
+                "histograms": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "count": histogram.count,
+                        "sum": round(histogram.sum, 6),
+                        "buckets": dict(zip(map(str, BUCKETS), histogram.buckets)),
+                    }
+                    for (name, labels), histogram in self.histograms.items()
+                ],
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": count}
+                    for (name, labels), count in self.counters.items()
+                ],
+                "last_cycles": list(self.last_cycles.values()),
+            }
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.respond(metrics.prometheus(), "text/plain; version=0.0.4")
+        elif self.path == "/metrics.json":
+            self.respond(json.dumps(metrics.snapshot()), "application/json")
+        else:
+            self.send_error(404)
+
+    def respond(self, text, content_type):
+        data = text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serve the metrics on /metrics (Prometheus) and /metrics.json
+def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+# Process-wide metrics
+metrics = Metrics()
@@ -1,8 +1,10 @@
+import json
+import hashlib
 import logging
 
 
 class Model:
-    def __init__(self, row):
+    def __init__(self, row, form=None):
         # Project detail
         self.oem = row[0]
         self.project = row[1]
@@ -28,10 +30,23 @@ class Model:
         self.share_url = row[20]
         self.share_date = row[21]
         self.share_status = row[22]
+        # Share columns (V-Y) as read, to skip the rows whose result did not change
+        self.share_values = row[20:24]
+        # Content hash of the request columns, the share columns are left out
+        # The form name keeps the rows of different forms apart in the journal
+        request = row[:20] if form is None else [form, *row[:20]]
+        self.hash = hashlib.sha256(
+            json.dumps(request, default=str).encode("utf-8")
+        ).hexdigest()
         # Error detail
         self.error = None
         self.valid = self.validate()
 
+    # Check if the raw row is marked for send and not sent yet
+    @staticmethod
+    def pending(row):
+        return row[19] == "Gönder." and row[22] != "Gönderildi."
+
     # Validate required fields
     def validate(self):
         # Skip validation if the row is already sent
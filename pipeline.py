@@ -0,0 +1,88 @@
+import queue
+import logging
+import threading
+import contextvars
+
+# Marks the end of the input of a stage
+DONE = object()
+
+
+class Stage:
+    def __init__(self, name, func, workers=1, batch_size=1, on_error=None):
+        # func takes a list of items and returns the items for the next stage
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+        # Called with the items and the exception when func raises
+        self.on_error = on_error
+
+
+class Pipeline:
+    def __init__(self, stages, queue_size=100):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.results = queue.Queue()
+
+    # Push the items through every stage, return the items leaving the last stage
+    def run(self, items):
+        threads = []
+        for i, stage in enumerate(self.stages):
+            output = self.queues[i + 1] if i + 1 < len(self.stages) else self.results
+            finished = [stage.workers]
+            lock = threading.Lock()
+            for n in range(stage.workers):
+                # The workers see the context of the caller, e.g. its cycle
+                thread = threading.Thread(
+                    target=contextvars.copy_context().run,
+                    args=(self.work, stage, self.queues[i], output, finished, lock),
+                    name=f"{stage.name}-{n}",
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+
+        for item in items:
+            self.queues[0].put(item)
+        for _ in range(self.stages[0].workers):
+            self.queues[0].put(DONE)
+        for thread in threads:
+            thread.join()
+
+        results = []
+        while not self.results.empty():
+            results.append(self.results.get())
+        return results
+
+    # Take batches of items from the input, pass the results to the output
+    # The last worker of a stage to finish closes the input of the next stage
+    def work(self, stage, input, output, finished, lock):
+        closed = False
+        while not closed:
+            batch = [input.get()]
+            while len(batch) < stage.batch_size and batch[-1] is not DONE:
+                try:
+                    batch.append(input.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is DONE:
+                batch.pop()
+                closed = True
+            if not batch:
+                continue
+
+            try:
+                for item in stage.func(batch):
+                    output.put(item)
+            except Exception as e:
+                logging.error("Stage %s failed. %s", stage.name, e)
+                if stage.on_error:
+                    stage.on_error(batch, e)
+
+        with lock:
+            finished[0] -= 1
+            last = finished[0] == 0
+        if last and output is not self.results:
+            next_stage = self.stages[self.queues.index(output)]
+            for _ in range(next_stage.workers):
+                output.put(DONE)
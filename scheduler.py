@@ -0,0 +1,88 @@
+import os
+import time
+import heapq
+import logging
+import itertools
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+FORM_WORKERS = int(os.getenv("FORM_WORKERS", "2"))
+
+
+class Task:
+    def __init__(self, name, frequency, func):
+        self.name = name
+        self.frequency = frequency
+        self.func = func
+        # Run again right after the running cycle, set by a wake up
+        self.rerun = False
+
+
+class Scheduler:
+    def __init__(self, workers=FORM_WORKERS):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="form"
+        )
+        # (due time, sequence, task) of the tasks waiting for their next run
+        self.heap = []
+        self.sequence = itertools.count()
+        self.running = set()
+        self.condition = threading.Condition()
+
+    # Schedule the task to run now, then every frequency seconds after each run
+    def add(self, name, frequency, func):
+        task = Task(name, frequency, func)
+        with self.condition:
+            self.push(task, time.monotonic())
+            self.condition.notify()
+        return task
+
+    def push(self, task, due):
+        heapq.heappush(self.heap, (due, next(self.sequence), task))
+
+    # Make every task due now, running tasks run again when they finish
+    def wake(self):
+        with self.condition:
+            now = time.monotonic()
+            self.heap = [(min(due, now), seq, task) for due, seq, task in self.heap]
+            heapq.heapify(self.heap)
+            for task in self.running:
+                task.rerun = True
+            self.condition.notify()
+
+    # Start the due tasks, the longest overdue first, while a worker is free
+    # A task never runs twice at the same time
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    if len(self.running) < self.workers and self.heap:
+                        if self.heap[0][0] <= now:
+                            break
+                        self.condition.wait(self.heap[0][0] - now)
+                    else:
+                        self.condition.wait()
+                _, _, task = heapq.heappop(self.heap)
+                self.running.add(task)
+
+            # Run every task in a fresh context, context variables do not leak
+            future = self.executor.submit(contextvars.Context().run, task.func)
+            future.add_done_callback(lambda future, task=task: self.done(task, future))
+
+    # Schedule the next run of the finished task
+    def done(self, task, future):
+        error = future.exception()
+        if error is not None:
+            logging.error(f"Cycle of '{task.name}' failed. {error}")
+        with self.condition:
+            self.running.discard(task)
+            delay = 0 if task.rerun else task.frequency
+            task.rerun = False
+            self.push(task, time.monotonic() + delay)
+            self.condition.notify()
@@ -1,30 +1,91 @@
-import time
+import os
+import re
 import json
 import base64
 import logging
-import requests
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+from graph import get_client, BATCH_LIMIT, IDEMPOTENT_METHODS
+from mailer import build_message
+from copytracker import get_tracker
+from cache import TTLCache
+from metrics import metrics
+
+# Load environment variables from .env file
+load_dotenv()
+SHARE_CACHE_TTL = int(os.getenv("SHARE_CACHE_TTL", "86400"))
+SHARE_CACHE_SIZE = int(os.getenv("SHARE_CACHE_SIZE", "256"))
+SHARE_CACHE_PATH = os.getenv("SHARE_CACHE_PATH")
+DIR_INDEX_TTL = int(os.getenv("DIR_INDEX_TTL", "900"))
+DIR_NORMALIZE = os.getenv("DIR_NORMALIZE", "false").lower() == "true"
+INVENTORY_WORKERS = int(os.getenv("INVENTORY_WORKERS", "4"))
+EXCEL_CHUNK_SIZE = int(os.getenv("EXCEL_CHUNK_SIZE", "1000"))
+
+# Sharing URL -> (drive_id, item_id)
+share_cache = TTLCache(SHARE_CACHE_SIZE, SHARE_CACHE_TTL, SHARE_CACHE_PATH)
+# "drive_id/parent_id" -> {directory name: item_id}
+dir_index_cache = TTLCache(SHARE_CACHE_SIZE, DIR_INDEX_TTL)
+
+
+# Normalize the case and whitespace of the directory name if enabled
+def normalize_dir_name(name):
+    if DIR_NORMALIZE:
+        return " ".join(name.split()).casefold()
+    return name
 
 
 class Sharepoint:
     def __init__(self, access_token, sp_url, verify=True):
-        self.base_url = "https://graph.microsoft.com/v1.0"
-        self.headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json",
-        }
+        self.client = get_client()
+        self.base_url = self.client.base_url
+        # Token string, or a provider called to get the token of each request
+        self.access_token = access_token
         self.verify = verify
+        # Workbook session reused by the workbook requests, if any
+        self.workbook_session_id = None
         # Initialize site_id and drive_id
+        self.sp_url = sp_url
         self.drive_id = None
         self.item_id = None
         self.init_ids(sp_url)
 
+    @property
+    def headers(self):
+        token = self.access_token
+        if callable(token):
+            token = token()
+        return {"Authorization": f"Bearer {token}"}
+
+    # Send a Graph request for this SharePoint location
+    def request(self, method, api, **kwargs):
+        kwargs.setdefault("headers", self.headers)
+        kwargs.setdefault("verify", self.verify)
+        if self.workbook_session_id and "/workbook/" in api:
+            kwargs["headers"] = {
+                **kwargs["headers"],
+                "workbook-session-id": self.workbook_session_id,
+            }
+        response = self.client.request(method, api, **kwargs)
+        # The cached IDs may be stale when an item is not found
+        if response.status_code == 404:
+            share_cache.invalidate(self.sp_url)
+        return response
+
     # Set the Item ID & Drive ID for the SharePoint URL
     def init_ids(self, sp_url):
+        ids = share_cache.get(sp_url)
+        if ids is not None:
+            self.drive_id, self.item_id = ids
+            return
+
         encoded_url = base64.b64encode(sp_url.encode("utf-8")).decode("utf-8")
         encoded_url = encoded_url.replace("/", "_").replace("+", "-").replace("=", "")
 
         api = f"{self.base_url}/shares/u!{encoded_url}/driveItem"
-        response = requests.get(api, headers=self.headers, verify=self.verify)
+        with metrics.timed("init_ids"):
+            response = self.request("GET", api)
         if response.status_code >= 400:
             logging.error(
                 f"Init ItemID & DriveID failed. {response.status_code} {response.text}"
@@ -34,6 +95,7 @@ class Sharepoint:
         data = response.json()
         self.drive_id = data["parentReference"]["driveId"]
         self.item_id = data["id"]
+        share_cache.set(sp_url, (self.drive_id, self.item_id))
 
     # Extract the item ID from the SharePoint URL
     def get_item_id(self):
@@ -41,38 +103,93 @@ class Sharepoint:
             raise Exception("Item ID is not initialized.")
         return self.item_id
 
-    # Get the list of items (files and folders) from the SharePoint
-    def get_children(self, item_id=None):
+    # Get the metadata of the item from the SharePoint
+    def get_item(self, item_id=None, select=None):
         if item_id is None:
             item_id = self.item_id
 
-        api = f"{self.base_url}/drives/{self.drive_id}/items/{item_id}/children"
-        response = requests.get(api, headers=self.headers, verify=self.verify)
+        api = f"{self.base_url}/drives/{self.drive_id}/items/{item_id}"
+        if select:
+            api = f"{api}?$select={select}"
+        response = self.request("GET", api)
         if response.status_code >= 400:
-            logging.error(
-                f"Get children failed. {response.status_code} {response.text}"
-            )
-            raise Exception("Failed to get children from SharePoint.")
+            logging.error(f"Get item failed. {response.status_code} {response.text}")
+            raise Exception("Failed to get item from SharePoint.")
+        return response.json()
 
-        items = response.json().get("value", [])
+    # Get the list of items (files and folders) from the SharePoint
+    # Follow @odata.nextLink until every page is read
+    def get_children(self, item_id=None, drive_id=None, select=None):
+        if item_id is None:
+            item_id = self.item_id
+        if drive_id is None:
+            drive_id = self.drive_id
+
+        items = []
+        api = f"{self.base_url}/drives/{drive_id}/items/{item_id}/children"
+        if select:
+            api = f"{api}?$select={select}"
+        while api:
+            response = self.request("GET", api)
+            if response.status_code >= 400:
+                logging.error(
+                    f"Get children failed. {response.status_code} {response.text}"
+                )
+                raise Exception("Failed to get children from SharePoint.")
+
+            data = response.json()
+            items.extend(data.get("value", []))
+            api = data.get("@odata.nextLink")
         return items
 
+    # Get the index of the directories in the parent directory in SharePoint
+    # Return the directory name -> item ID mapping, build it when missing
+    def get_dir_index(self, parent_id, drive_id=None, refresh=False):
+        if drive_id is None:
+            drive_id = self.drive_id
+
+        key = f"{drive_id}/{parent_id}"
+        index = None if refresh else dir_index_cache.get(key)
+        if index is None:
+            index = {
+                normalize_dir_name(item["name"]): item["id"]
+                for item in self.get_children(parent_id, drive_id)
+                if item.get("folder")
+            }
+            dir_index_cache.set(key, index)
+        return index
+
     # Find the item ID from a given directory in SharePoint
-    def find_dir(self, parent_id, dir_name):
-        items = self.get_children(parent_id)
-        for item in items:
-            if item.get("folder") and item["name"] == dir_name:
-                return item["id"]
+    def find_dir(self, parent_id, dir_name, drive_id=None):
+        name = normalize_dir_name(dir_name)
+        dir_id = self.get_dir_index(parent_id, drive_id).get(name)
+        if dir_id is None:
+            # The directory may be created after the index is built
+            dir_id = self.get_dir_index(parent_id, drive_id, refresh=True).get(name)
+        if dir_id is not None:
+            return dir_id
         logging.error(f"Directory not found: {dir_name} in SharePoint.")
         raise Exception(f"Company directory {dir_name} NOT found in SharePoint.")
 
     # Copy the item to a new location in SharePoint
     def copy(self, dest_drive_id, dest_parent_id, company, dest_name, item_id=None):
+        future = self.copy_async(
+            dest_drive_id, dest_parent_id, company, dest_name, item_id
+        )
+        with metrics.timed("monitor_copy"):
+            return future.result()
+
+    # Start copying the item to a new location in SharePoint
+    # Return a Future resolved with the item ID of the copy
+    def copy_async(
+        self, dest_drive_id, dest_parent_id, company, dest_name, item_id=None
+    ):
         if item_id is None:
             item_id = self.item_id
 
         # Search for the destination directory in parent directory in SharePoint
-        dest_id = self.find_dir(dest_parent_id, company)
+        with metrics.timed("find_dir"):
+            dest_id = self.find_dir(dest_parent_id, company, dest_drive_id)
 
         # Copy the item to the destination directory
         api = f"{self.base_url}/drives/{self.drive_id}/items/{item_id}/copy"
@@ -80,49 +197,46 @@ class Sharepoint:
             "parentReference": {"driveId": dest_drive_id, "id": dest_id},
             "name": dest_name,
         }
-        response = requests.post(
-            api, headers=self.headers, json=data, verify=self.verify
-        )
+        response = self.request("POST", api, json=data)
         if response.status_code == 202:
             location = response.headers.get("Location")
-            return self.monitor_copy(location)
+            return get_tracker().track(location, verify=self.verify)
         else:
             logging.error(f"Copy failed. {response.status_code} {response.text}")
             raise Exception("SharePoint copy operation failed.")
 
     # Monitor the copy operation
     def monitor_copy(self, location):
-        while True:
-            response = requests.get(
-                location,
-                headers={
-                    "Content-Type": "application/json",
-                },
-                verify=self.verify,
-            )
-            if response.status_code >= 400:
-                logging.error(
-                    f"Monitor copy failed. {response.status_code} {response.text}"
-                )
-                raise Exception("SharePoint copy operation failed.")
-
-            result = response.json()
-            status = result.get("status")
-            if status == "completed":
-                logging.info("Copy operation successful.")
-                return result.get("resourceId")
-            elif status == "failed":
-                logging.error(f"Copy operation failed: {result.get('error')}")
-                raise Exception("SharePoint copy operation failed.")
-            else:
-                # Wait for 5 seconds
-                time.sleep(5)
+        with metrics.timed("monitor_copy"):
+            return get_tracker().track(location, verify=self.verify).result()
 
     # Get the file information from the SharePoint
+    # List the folder tree level by level, the folders of a level in parallel
     def get_file_details(self, item_id):
+        children = {}
+        level = [item_id]
+        with ThreadPoolExecutor(max_workers=INVENTORY_WORKERS) as executor:
+            while level:
+                results = executor.map(
+                    lambda folder_id, context: context.run(
+                        self.get_children, folder_id, select="id,name,size,folder"
+                    ),
+                    level,
+                    [contextvars.copy_context() for _ in level],
+                )
+                next_level = []
+                for folder_id, items in zip(level, results):
+                    children[folder_id] = items
+                    next_level.extend(item["id"] for item in items if "folder" in item)
+                level = next_level
+
         file_details = []
-        items = self.get_children(item_id)
-        for item in items:
+        self.collect_file_details(children, item_id, file_details)
+        return file_details
+
+    # Collect the file details depth-first from the listed folder tree
+    def collect_file_details(self, children, item_id, file_details):
+        for item in children[item_id]:
             if "folder" not in item:
                 # Only include files, not folders
                 file_name = item["name"]
@@ -131,8 +245,7 @@ class Sharepoint:
                 file_details.append((file_name, file_size_mb))
             else:
                 # Recursively collect details from subfolders
-                file_details.extend(self.get_file_details(item["id"]))
-        return file_details
+                self.collect_file_details(children, item["id"], file_details)
 
     # Create a share link and give permission
     # for given item_id to given emails in SharePoint
@@ -143,9 +256,8 @@ class Sharepoint:
             "type": "view",
             "scope": "users",
         }
-        response = requests.post(
-            share_api, headers=self.headers, json=data, verify=self.verify
-        )
+        # createLink returns the existing link when called again, safe to retry
+        response = self.request("POST", share_api, json=data, idempotent=True)
         if response.status_code >= 400:
             logging.error(
                 f"Create share link failed. {response.status_code} {response.text}"
@@ -162,64 +274,65 @@ class Sharepoint:
             "roles": ["read"],
             "recipients": [{"email": email} for email in emails],
         }
-        response = requests.post(
-            invite_api, headers=self.headers, json=data, verify=self.verify
-        )
+        # No invitation mail is sent, granting the same access again is harmless
+        response = self.request("POST", invite_api, json=data, idempotent=True)
         if response.status_code >= 400:
             logging.error(f"Invite user failed. {response.status_code} {response.text}")
             raise Exception("Failed to create share link in SharePoint.")
 
-        logging.info(f"Share link created successfully: {share_url}")
+        logging.info("Share link created successfully: %s", share_url)
         return share_url
 
     # Send an email
     def send_email(self, data, dest_name, files):
-        # Generate the file listing with names and sizes
-        file_list = ""
-        for idx, (name, size) in enumerate(files, start=1):
-            file_list += f"{idx}-{name}<br>Dosya boyutu: {size}<br>"
-
-        # Message content
-        message = {
-            "message": {
-                "subject": f"RPABAY_DATA_PAYLASIMI_{data.sp}_{data.subject}",
-                "body": {
-                    "contentType": "HTML",
-                    "content": f"""
-                    <p>Merhaba {data.sp_r},</p>
-                    <p>Aşağıdaki linkte, {data.sp} Firması için ... A.Ş tarafından {dest_name} dosyası erişiminize açılmıştır.</p>
-                    <p><b>OEM:</b> {data.oem}</p>
-                    <p><b>Project:</b> {data.project}</p>
-                    <p><b>System:</b> {data.system}</p>
-                    <p><b>Part Name:</b> {data.partname}</p>
-                    <p><b>Part Number:</b> {data.partno}</p>
-                    <p><b>Link:</b><br><a href="{data.share_url}">{dest_name}</a></p>
-                    <p><b>Dosya içeriği:</b><br>{file_list}</p>
-                    <p><b>Yorum / Talep:</b></p>
-                    <p><b>{data.comment}</b></p>
-                    <p><b>Firma Sorumlusu:</b> {data.r}</p>
-                    <p>İyi çalışmalar.</p>
-                    """,
-                },
-                "toRecipients": [{"emailAddress": {"address": data.sp_r_email}}],
-                "ccRecipients": [{"emailAddress": {"address": data.r_email}}]
-                + [{"emailAddress": {"address": cc}} for cc in data.r_cc_email],
-            }
-        }
+        message = build_message(data, dest_name, files)
         # Send the email
         api = f"{self.base_url}/me/sendMail"
-        response = requests.post(
-            api, headers=self.headers, json=message, verify=self.verify
-        )
+        response = self.request("POST", api, json=message)
         if response.status_code >= 400:
             logging.error(f"Send email failed. {response.status_code} {response.text}")
             raise Exception("Failed to send email.")
-        logging.info(f"Send email to {data.sp_r_email} successfully.")
+        logging.info("Send email to %s successfully.", data.sp_r_email)
+
+    # Create a workbook session, the next workbook requests reuse it
+    def excel_create_session(self, item_id, persist=True):
+        api = f"{self.base_url}/drives/{self.drive_id}/items/{item_id}/workbook/createSession"
+        response = self.request(
+            "POST", api, json={"persistChanges": persist}, idempotent=True
+        )
+        if response.status_code >= 400:
+            logging.error(
+                f"Create workbook session failed. {response.status_code} {response.text}"
+            )
+            raise Exception("Failed to create the excel session in SharePoint.")
+        self.workbook_session_id = response.json()["id"]
+        return self.workbook_session_id
+
+    # Keep the workbook session alive
+    def excel_refresh_session(self, item_id):
+        api = f"{self.base_url}/drives/{self.drive_id}/items/{item_id}/workbook/refreshSession"
+        response = self.request("POST", api, idempotent=True)
+        if response.status_code >= 400:
+            logging.error(
+                f"Refresh workbook session failed. {response.status_code} {response.text}"
+            )
+            raise Exception("Failed to refresh the excel session in SharePoint.")
+
+    # Close the workbook session
+    def excel_close_session(self, item_id):
+        api = f"{self.base_url}/drives/{self.drive_id}/items/{item_id}/workbook/closeSession"
+        response = self.request("POST", api, idempotent=True)
+        self.workbook_session_id = None
+        if response.status_code >= 400:
+            logging.error(
+                f"Close workbook session failed. {response.status_code} {response.text}"
+            )
+            raise Exception("Failed to close the excel session in SharePoint.")
 
     # Read the data from the excel file
     def excel_read(self, item_id, sheet_name, start_row):
         api = f"{self.base_url}/drives/{self.drive_id}/items/{item_id}/workbook/worksheets('{sheet_name}')/usedRange"
-        response = requests.get(api, headers=self.headers)
+        response = self.request("GET", api)
         if response.status_code >= 400:
             logging.error(
                 f"Read excel file failed. {response.status_code} {response.text}"
@@ -236,13 +349,93 @@ class Sharepoint:
                 filtered_rows.append((idx, row))
         return filtered_rows
 
+    # Read the data from the excel file in blocks of chunk_size rows
+    # Only the columns from col_start to col_end are fetched
+    # Yield the (row index, values) of the non-empty rows
+    def excel_read_rows(
+        self,
+        item_id,
+        sheet_name,
+        start_row,
+        col_start="A",
+        col_end="Y",
+        chunk_size=None,
+    ):
+        chunk_size = chunk_size or EXCEL_CHUNK_SIZE
+        end_row = self.excel_last_row(item_id, sheet_name)
+        for block_start in range(start_row, end_row + 1, chunk_size):
+            block_end = min(block_start + chunk_size - 1, end_row)
+            api = f"{self.base_url}/drives/{self.drive_id}/items/{item_id}/workbook/worksheets('{sheet_name}')/range(address='{col_start}{block_start}:{col_end}{block_end}')?$select=values"
+            response = self.request("GET", api)
+            if response.status_code >= 400:
+                logging.error(
+                    f"Read excel file failed. {response.status_code} {response.text}"
+                )
+                raise Exception("Failed to read the excel file from SharePoint.")
+
+            rows = response.json().get("values") or []
+            for idx, row in enumerate(rows, start=block_start):
+                if any(cell for cell in row):
+                    yield idx, row
+
+    # Get the index of the last used row of the excel sheet
+    def excel_last_row(self, item_id, sheet_name):
+        api = f"{self.base_url}/drives/{self.drive_id}/items/{item_id}/workbook/worksheets('{sheet_name}')/usedRange(valuesOnly=true)?$select=address"
+        response = self.request("GET", api)
+        if response.status_code >= 400:
+            logging.error(
+                f"Read excel file failed. {response.status_code} {response.text}"
+            )
+            raise Exception("Failed to read the excel file from SharePoint.")
+
+        # The address looks like "Sheet1!A2:AB500"
+        address = response.json()["address"].split("!")[-1]
+        return int(re.sub(r"[^0-9]", "", address.split(":")[-1]) or 0)
+
     # Write the data to the excel file
     def excel_write_row(self, item_id, sheet_name, row_idx, col_start, col_end, values):
         api = f"{self.base_url}/drives/{self.drive_id}/items/{item_id}/workbook/worksheets('{sheet_name}')/range(address='{col_start}{row_idx}:{col_end}{row_idx}')"
         data = {"values": values}
-        response = requests.patch(api, headers=self.headers, data=json.dumps(data))
+        response = self.request("PATCH", api, data=json.dumps(data))
         if response.status_code >= 400:
             logging.error(
                 f"Write excel file failed. {response.status_code} {response.text}"
             )
             raise Exception("Failed to write the excel file to SharePoint.")
+
+    # Build a Graph $batch sub-request writing a block of rows to the excel file
+    def excel_write_request(
+        self, item_id, sheet_name, row_start, row_end, col_start, col_end, values
+    ):
+        request = {
+            "method": "PATCH",
+            "url": f"/drives/{self.drive_id}/items/{item_id}/workbook/worksheets('{sheet_name}')/range(address='{col_start}{row_start}:{col_end}{row_end}')",
+            "headers": {"Content-Type": "application/json"},
+            "body": {"values": values},
+        }
+        if self.workbook_session_id:
+            request["headers"]["workbook-session-id"] = self.workbook_session_id
+        return request
+
+    # Send up to BATCH_LIMIT sub-requests in a single Graph $batch call
+    # A failed batch is sent again only when every sub-request is idempotent
+    # Return the sub-responses keyed by their request id
+    def batch(self, requests, endpoint=None):
+        if len(requests) > BATCH_LIMIT:
+            raise ValueError(f"A batch can hold at most {BATCH_LIMIT} requests.")
+
+        api = f"{self.base_url}/$batch"
+        response = self.request(
+            "POST",
+            api,
+            json={"requests": requests},
+            endpoint=endpoint,
+            idempotent=all(
+                request["method"] in IDEMPOTENT_METHODS for request in requests
+            ),
+        )
+        if response.status_code >= 400:
+            logging.error(f"Batch failed. {response.status_code} {response.text}")
+            raise Exception("SharePoint batch request failed.")
+
+        return {item["id"]: item for item in response.json().get("responses", [])}
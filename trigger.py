@@ -0,0 +1,112 @@
+import os
+import json
+import time
+import logging
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+TRIGGER_HOST = os.getenv("TRIGGER_HOST", "127.0.0.1")
+TRIGGER_PORT = int(os.getenv("TRIGGER_PORT", "0"))
+TRIGGER_SECRET = os.getenv("TRIGGER_SECRET")
+TRIGGER_DEBOUNCE = float(os.getenv("TRIGGER_DEBOUNCE", "5"))
+
+
+class TriggerHandler(BaseHTTPRequestHandler):
+    # Answer a Graph change notification or a Power Automate callback
+    def do_POST(self):
+        query = parse_qs(urlparse(self.path).query)
+
+        # Graph validates the subscription endpoint by echoing the token
+        if "validationToken" in query:
+            self.respond(200, query["validationToken"][0], "text/plain")
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        if not self.server.trigger.accept(body):
+            self.respond(403, "Forbidden")
+            return
+
+        self.server.trigger.fire()
+        self.respond(202, "Accepted")
+
+    def respond(self, status, text, content_type="text/plain"):
+        data = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug(f"Trigger {self.address_string()} {format % args}")
+
+
+class Trigger:
+    def __init__(
+        self,
+        host=TRIGGER_HOST,
+        port=TRIGGER_PORT,
+        secret=TRIGGER_SECRET,
+        debounce=TRIGGER_DEBOUNCE,
+    ):
+        self.secret = secret
+        self.debounce = debounce
+        self.event = threading.Event()
+        self.server = ThreadingHTTPServer((host, port), TriggerHandler)
+        self.server.trigger = self
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="trigger", daemon=True
+        )
+
+    @property
+    def address(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        logging.info(f"Listening for change notifications on {self.address}")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # Check the client state of the notification when a secret is set
+    # Power Automate callbacks may post an empty body with the secret as clientState
+    def accept(self, body):
+        if not self.secret:
+            return True
+        try:
+            data = json.loads(body or b"{}")
+        except ValueError:
+            return False
+        if not isinstance(data, dict):
+            return False
+        notifications = data.get("value", [data])
+        if not isinstance(notifications, list):
+            return False
+        return any(
+            isinstance(notification, dict)
+            and notification.get("clientState") == self.secret
+            for notification in notifications
+        )
+
+    # Start a cycle as soon as possible
+    def fire(self):
+        self.event.set()
+
+    # Wait for a notification or until the polling timeout runs out
+    # Notifications arriving within the debounce window are merged into one cycle
+    # Return True if the wait ended because of a notification
+    def wait(self, timeout):
+        notified = self.event.wait(timeout)
+        if notified:
+            time.sleep(self.debounce)
+        self.event.clear()
+        return notified